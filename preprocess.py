@@ -1,10 +1,19 @@
 import pandas as pd
+import numpy as np
 import os
-import gzip
-import collections
+import json
 import re
+import ahocorasick
+import rapidgzip
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from numba import njit, prange
 from sklearn.model_selection import train_test_split
 import pickle
+from functools import partial, wraps
+from multiprocessing import Pool
 
 # Symptom Lexicon (mocks UMLS 'sosy' terms). INstead of MetaMap
 SYMPTOMS = {
@@ -24,28 +33,173 @@ SYMPTOMS = {
 # Normalize: lower + handle variations
 SYMPTOMS = {s.lower() for s in SYMPTOMS}
 
-def load_mimic_data(data_dir):
+# Symptoms are carried through the pipeline as integer ids into SYM_LIST
+SYM_LIST = sorted(SYMPTOMS)
+
+# Columns read from each MIMIC table; tables not listed here are read in full
+NEEDED_COLS = {
+    'NOTEEVENTS': ['HADM_ID', 'CATEGORY', 'TEXT'],
+    'DIAGNOSES_ICD': ['HADM_ID', 'ICD9_CODE'],
+}
+
+# open_csv fixes column types from the first block, so pin the ones later blocks could break.
+# ICD9 codes like 'V3000' and '0389' must stay strings, and HADM_ID is float64 because some
+# notes have none. CATEGORY has a handful of values, so it is read straight into a pandas category
+COLUMN_TYPES = {
+    'HADM_ID': pa.float64(),
+    'ICD9_CODE': pa.string(),
+    'TEXT': pa.string(),
+    'CATEGORY': pa.dictionary(pa.int32(), pa.string()),
+}
+
+# Section headers in discharge summaries, e.g. '\nSocial History:\n'
+_SECTION_PATTERN_RE = re.compile(r'(^|\n)\s*([A-Z][A-Za-z\s/&-]+:)\s*(\n|\Z)')
+_SECTION_HEADER_RE = re.compile(r'\n\s*([A-Z][A-Za-z\s/&-]+):\s*\n')
+
+# Sections dropped by filter_sections
+_REMOVE_SECTIONS = frozenset({
+    'Social History',
+    'Medications on Admission',
+    'Discharge Diagnosis',
+})
+
+# Negation cues looked for in the ~50 chars before a symptom mention
+_NEGATION_WINDOW = 50
+_NEGATION_RE = re.compile(
+    r'\b(denies?|denied|no\s+(history\s+of\s+)?|without|never\s+had|not\s+complaining|not\s+report|not\s+have|not\s+experiencing|absence\s+of)\b'
+)
+
+# One Aho-Corasick automaton per symptom lexicon, so every note is scanned once
+# for all symptoms instead of once per symptom
+_SYMPTOM_AUTOMATA = {}
+
+# Payloads are (id, symptom) with ids indexing sorted(symptom_set), i.e. SYM_LIST for SYMPTOMS
+def build_symptom_automaton(symptom_set):
+    automaton = ahocorasick.Automaton()
+    for sym_id, sym in enumerate(sorted(symptom_set)):
+        # Multi-word symptoms are stored with single spaces, text whitespace is collapsed to match
+        sym = ' '.join(sym.split())
+        automaton.add_word(sym, (sym_id, sym))
+    automaton.make_automaton()
+    return automaton
+
+def _get_symptom_automaton(symptom_set):
+    key = frozenset(symptom_set)
+    if key not in _SYMPTOM_AUTOMATA:
+        _SYMPTOM_AUTOMATA[key] = build_symptom_automaton(key)
+    return _SYMPTOM_AUTOMATA[key]
+
+# Pool initializer: build the automaton once per worker rather than pickling it with every task
+def _init_symptom_worker(symptom_set):
+    _get_symptom_automaton(symptom_set)
+
+def _is_word_char(c):
+    return c.isalnum() or c == '_'
+
+def load_mimic_table(data_dir, table):
+    """
+    Load a single MIMIC-III table from the specified directory.
+    """
+    file_path = os.path.join(data_dir, f"{table}.csv.gz")
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"{file_path} not found.")
+
+    read_options = pacsv.ReadOptions(use_threads=True)
+    # Note text contains quoted newlines
+    parse_options = pacsv.ParseOptions(newlines_in_values=True)
+    convert_options = pacsv.ConvertOptions(
+        include_columns=NEEDED_COLS.get(table, []),
+        column_types=COLUMN_TYPES,
+        # Empty fields become NaN, as with pd.read_csv
+        strings_can_be_null=True,
+    )
+    # rapidgzip inflates deflate blocks in parallel; pyarrow decodes the CSV on all cores
+    with rapidgzip.open(file_path, parallelization=os.cpu_count()) as f:
+        if table == 'NOTEEVENTS':
+            return _read_discharge_notes(f, read_options, parse_options, convert_options)
+        return pacsv.read_csv(
+            f,
+            read_options=read_options,
+            parse_options=parse_options,
+            convert_options=convert_options,
+        ).to_pandas()
+
+# Stream NOTEEVENTS block by block, keeping only discharge summaries with text,
+# so the full table is never held in memory
+# Section 2.1
+def _read_discharge_notes(f, read_options, parse_options, convert_options):
+    reader = pacsv.open_csv(
+        f,
+        read_options=read_options,
+        parse_options=parse_options,
+        convert_options=convert_options,
+    )
+    batches = []
+    for batch in reader:
+        keep = pc.and_(
+            pc.equal(batch.column('CATEGORY'), 'Discharge summary'),
+            pc.is_valid(batch.column('TEXT')),
+        )
+        batches.append(batch.filter(keep))
+    return pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+
+def load_mimic_data(data_dir, tables=('NOTEEVENTS', 'DIAGNOSES_ICD')):
     """
     Load MIMIC-III dataset from the specified directory.
+    Only the tables the pipeline uses are read by default; pass e.g.
+    'ADMISSIONS' or 'D_ICD_DIAGNOSES' in tables to load them too.
     """
-    tables = ['ADMISSIONS', 'NOTEEVENTS', 'DIAGNOSES_ICD', 'D_ICD_DIAGNOSES',]
     data = {}
     
     for table in tables:
-        file_path = os.path.join(data_dir, f"{table}.csv.gz")
-        if os.path.exists(file_path):
-            with gzip.open(file_path, 'rt') as f:
-                data[table] = pd.read_csv(f)
-        else:
-            raise FileNotFoundError(f"{file_path} not found.")
+        data[table] = load_mimic_table(data_dir, table)
     
     return data
 
-# Only keep category = discharge summary
+# Arrow hands list columns back as ndarrays; string lists go back to Python lists
+def _read_parquet_cache(path):
+    table = pq.read_table(path)
+    df = table.to_pandas()
+    for field in table.schema:
+        if pa.types.is_list(field.type) and pa.types.is_string(field.type.value_type):
+            df[field.name] = pd.Series(table.column(field.name).to_pylist(), index=df.index, dtype=object)
+    return df
+
+def cache_to_parquet(cache_path, inputs=()):
+    """
+    Checkpoint a pipeline stage to Parquet. The cached frame is reused while it is
+    newer than every input file; otherwise the stage reruns and rewrites it.
+    Stages are called with keyword arguments, which fill any {placeholders} in the paths.
+    Both paths return the frame as read back from Parquet, so dtypes never depend on cache state.
+    The absolute input paths are stored in the file's metadata, so a cache written from
+    another data_dir is never reused.
+    """
+    def decorator(stage):
+        @wraps(stage)
+        def wrapper(**kwargs):
+            path = cache_path.format(**kwargs)
+            input_paths = [os.path.abspath(p.format(**kwargs)) for p in inputs]
+            source = json.dumps(input_paths).encode()
+            if os.path.exists(path) and all(
+                os.path.exists(p) and os.path.getmtime(p) < os.path.getmtime(path)
+                for p in input_paths
+            ) and (pq.read_schema(path).metadata or {}).get(b'cache_inputs') == source:
+                print(f"  Loading cached {path}")
+                return _read_parquet_cache(path)
+
+            df = stage(**kwargs)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            table = pa.Table.from_pandas(df)
+            table = table.replace_schema_metadata({**table.schema.metadata, b'cache_inputs': source})
+            pq.write_table(table, path, compression='zstd')
+            return _read_parquet_cache(path)
+        return wrapper
+    return decorator
+
+# Category = discharge summary and missing text are already filtered while
+# streaming NOTEEVENTS in load_mimic_table
 # Section 2.1
 def filter_discharges(data, noteevents_df):
-    noteevents_df = noteevents_df[noteevents_df['CATEGORY'] == 'Discharge summary']
-    noteevents_df = noteevents_df.dropna(subset=['TEXT'])
     # Remote dupes
     noteevents_df = noteevents_df.drop_duplicates(subset=['HADM_ID'], keep='last')
     return noteevents_df
@@ -54,37 +208,48 @@ def filter_discharges(data, noteevents_df):
 # 2.1
 def truncate_icd9_codes(diag_codes):
     df = diag_codes.copy()
-    df['ICD9_CODE_3DIGIT'] = df['ICD9_CODE'].fillna('').astype(str).str.slice(0, 3)
-    df = df[df['ICD9_CODE_3DIGIT'] != '']
+    # Arrow-backed strings slice in C and keep missing codes as NA, no fillna('') copy
+    codes = df['ICD9_CODE'].astype('string[pyarrow]').str.slice(0, 3)
+    keep = codes.notna() & (codes != '')
+    df = df[keep]
+    # Category codes make the counting and isin() calls downstream cheap
+    df['ICD9_CODE_3DIGIT'] = codes[keep].astype('category')
     print(f"Total unique 3-digit codes: {df['ICD9_CODE_3DIGIT'].nunique()} (expected: 931)")
     return df
 
 # Section 3.1
 def select_top_diseases(diagnoses_df, top_n=50):
-    disease_counts = collections.Counter(diagnoses_df['ICD9_CODE_3DIGIT'])
-    top_diseases = [disease for disease, count in disease_counts.most_common(top_n)]
+    codes = diagnoses_df['ICD9_CODE_3DIGIT']
+    # Reindex by first appearance (which also drops a categorical's unused codes), then a
+    # stable sort breaks ties by first-seen order, as Counter.most_common did
+    disease_counts = codes.value_counts(sort=False).reindex(codes.unique())
+    disease_counts = disease_counts.sort_values(ascending=False, kind='stable')
+    top_diseases = disease_counts.index[:top_n].tolist()
 
     disease_to_index = {disease: idx for idx, disease in enumerate(top_diseases)}
-
-    # calculate coverage
-    total_admissions = diagnoses_df['HADM_ID'].nunique()
-    admissions_with_top_diseases = diagnoses_df[
-        diagnoses_df['ICD9_CODE_3DIGIT'].isin(top_diseases)
-    ]['HADM_ID'].nunique()
+    # Built once; every isin() against the top diseases takes this set
+    top_set = set(top_diseases)
+
+    # calculate coverage: one groupby over HADM_ID gives both counts
+    has_top_disease = diagnoses_df['ICD9_CODE_3DIGIT'].isin(top_set).groupby(
+        diagnoses_df['HADM_ID']
+    ).any()
+    total_admissions = len(has_top_disease)
+    admissions_with_top_diseases = has_top_disease.sum()
     coverage = admissions_with_top_diseases / total_admissions
 
     print(f"Top {top_n} diseases cover {coverage:.2%} of all diagnoses.")
     
-    return top_diseases, disease_to_index, coverage
+    return top_diseases, disease_to_index, coverage, top_set
 
 # Filter for top dieases
 # Section 3.1
-def filter_top_diseases(diagnoses_df, noteevents_df, top_diseases):
-    filtered = diagnoses_df[diagnoses_df['ICD9_CODE_3DIGIT'].isin(top_diseases)].copy()
+def filter_top_diseases(diagnoses_df, noteevents_df, top_set):
+    filtered = diagnoses_df[diagnoses_df['ICD9_CODE_3DIGIT'].isin(top_set)].copy()
 
     unique_hadm_ids = filtered['HADM_ID'].unique()
     
-    filtered_notes = noteevents_df[noteevents_df['HADM_ID'].isin(filtered['HADM_ID'].unique())].copy()
+    filtered_notes = noteevents_df[noteevents_df['HADM_ID'].isin(unique_hadm_ids)].copy()
 
     print(f"  Unique admissions with top diseases: {len(unique_hadm_ids)}")
     print(f"  Discharge summaries retained: {len(filtered_notes)}")
@@ -96,126 +261,146 @@ def filter_top_diseases(diagnoses_df, noteevents_df, top_diseases):
 # Need to find section headers in the discharge summaries
 def identify_sections(text):
     # match section headers that may appear at start, middle, or end
-    section_pattern = r'(^|\n)\s*([A-Z][A-Za-z\s/&-]+:)\s*(\n|\Z)'
-    matches = re.findall(section_pattern, text)
+    matches = _SECTION_PATTERN_RE.findall(text)
     return [m[1].rstrip(':') for m in matches]
 
 # Need to remove these
 # Section 2.1
 def filter_sections(text):
-    remove_sections = [
-        'Social History',
-        'Medications on Admission',
-        'Discharge Diagnosis',
-    ]
-
-    split_pattern = r'(\n\s*[A-Z][A-Za-z\s/&-]+:\s*\n)'
-    parts = re.split(split_pattern, text)
-
-    # keep only non-removed sections
-    filtered_parts = []
-    i = 0
-    while i < len(parts):
-        part = parts[i]
-        if re.match(r'\n\s*[A-Z][A-Za-z\s/&-]+:\s*\n', part):
-
-            # This is a section header
-            header = part.strip().rstrip(':')
-            if header not in remove_sections:
-                # Keep header + next content block
-                filtered_parts.append(part)
-                if i + 1 < len(parts):
-                    filtered_parts.append(parts[i + 1])
-            else:
-                # Skip header and content
-                i += 1  
-            i += 1 
-        else:
-            if not filtered_parts:
-                filtered_parts.append(part)
-            i += 1
-
-    return ''.join(filtered_parts)
+    matches = list(_SECTION_HEADER_RE.finditer(text))
+    if not matches:
+        return text
+
+    # Always keep the preamble before the first header
+    kept = [text[:matches[0].start()]]
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        if match.group(1) not in _REMOVE_SECTIONS:
+            # Keep header + content up to the next header
+            end = next_match.start() if next_match else len(text)
+            kept.append(text[match.start():end])
+
+    return ''.join(kept)
 
 def process_section_filtering(input_file, output_file):
-    df = pd.read_pickle(input_file)
+    df = pd.read_parquet(input_file)
     df['TEXT_FILTERED'] = df['TEXT_CLEANED'].apply(filter_sections)
-    df.to_pickle(output_file)
+    df.to_parquet(output_file, compression='zstd', engine='pyarrow')
     print(f"Filtered {len(df)} summaries")
 
+# Lowercase notes and collapse whitespace runs in one vectorized pass, so
+# multi-word symptoms match across line breaks
+def normalize_notes(texts):
+    return texts.astype('string[pyarrow]').str.lower().str.replace(r'\s+', ' ', regex=True)
+
 # Section 2.1
 # Mocking metamap. Replace with Metamap later
+# Expects text already run through normalize_notes. Returns parallel arrays of
+# symptom ids and negation flags
 def extract_symptoms_from_text(text, symptom_set):
     if pd.isna(text):
-        return []
-    text_lower = text.lower()
-    found_symptoms = []
-
-    NEGATION_PATTERNS = [
-        r'\b(denies?|denied|no\s+(history\s+of\s+)?|without|never\s+had|not\s+complaining|not\s+report|not\s+have|not\s+experiencing|absence\s+of)\b'
-    ]
-
-    for sym in symptom_set:
-        escaped = re.escape(sym)
-        # Handle multi-word symptoms
-        pattern = r'\b' + escaped.replace(' ', r'\s+') + r'\b'
-        matches = list(re.finditer(pattern, text_lower))
-
-        for m in matches:
-            start, end = m.span()
-            # Look back ~50 chars
-            window_start = max(0, start - 50)
-            pre_text = text_lower[window_start:start]
-
-            is_negated = False
-            for neg_pat in NEGATION_PATTERNS:
-                if re.search(neg_pat, pre_text):
-                    is_negated = True
-                    break
-
-            found_symptoms.append({
-                'symptom': sym,
-                'is_negated': is_negated
-            })
-
-    # Deduplicate
-    seen = set()
-    unique = []
-    for item in found_symptoms:
-        key = (item['symptom'], item['is_negated'])
-        if key not in seen:
-            seen.add(key)
-            unique.append(item)
-    return unique
-
+        return np.empty(0, dtype=np.int16), np.empty(0, dtype=bool)
+    automaton = _get_symptom_automaton(symptom_set)
+
+    matched = []
+    starts = []
+    for end_idx, (sym_id, sym) in automaton.iter(text):
+        start = end_idx - len(sym) + 1
+        # Word boundaries on both sides
+        if start > 0 and _is_word_char(text[start - 1]):
+            continue
+        if end_idx + 1 < len(text) and _is_word_char(text[end_idx + 1]):
+            continue
+        matched.append(sym_id)
+        starts.append(start)
+
+    # Run the negation regex once over the note, then find the last cue ending
+    # at or before each match and check it falls within the look-back window
+    neg_ends = np.fromiter((m.end() for m in _NEGATION_RE.finditer(text)), dtype=np.int64)
+    starts = np.array(starts, dtype=np.int64)
+    idx = np.searchsorted(neg_ends, starts, side='right')
+    prev_end = neg_ends[np.maximum(idx - 1, 0)] if len(neg_ends) else starts
+    negated = (idx > 0) & (starts - prev_end <= _NEGATION_WINDOW)
+
+    sym_ids = np.array(matched, dtype=np.int16)
+
+    # Deduplicate (symptom, negated) pairs, keeping first-mention order
+    keys = sym_ids.astype(np.int32) * 2 + negated
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    return sym_ids[first], negated[first]
+
+
+# Pack per-note symptom id lists into flat ids plus row offsets (row r is
+# flat_syms[row_ptr[r]:row_ptr[r + 1]]), keeping each note's symptom order
+def pack_symptom_lists(symptom_lists):
+    lengths = symptom_lists.str.len().to_numpy(dtype=np.int64)
+    row_ptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=row_ptr[1:])
+
+    flat_syms = np.concatenate([np.empty(0, dtype=np.int32), *symptom_lists]).astype(np.int32)
+    return flat_syms, row_ptr
+
+# Single pass over packed rows (flat_syms/row_ptr): keep valid symptoms, truncate each row to
+# max_per_row and drop rows left with fewer than min_per_row. Returns the kept rows' packed
+# arrays and a row mask
+@njit(parallel=True, cache=True)
+def filter_and_truncate(flat_syms, row_ptr, valid_mask, max_per_row, min_per_row):
+    n_rows = len(row_ptr) - 1
+    counts = np.zeros(n_rows, dtype=np.int64)
+    for r in prange(n_rows):
+        kept = 0
+        for j in range(row_ptr[r], row_ptr[r + 1]):
+            if kept == max_per_row:
+                break
+            if valid_mask[flat_syms[j]]:
+                kept += 1
+        counts[r] = kept
+
+    keep_row = counts >= min_per_row
+    out_row = np.cumsum(keep_row) - 1
+    out_ptr = np.zeros(keep_row.sum() + 1, dtype=np.int64)
+    out_ptr[1:] = np.cumsum(counts[keep_row])
+    out_syms = np.empty(out_ptr[-1], dtype=flat_syms.dtype)
+
+    for r in prange(n_rows):
+        if not keep_row[r]:
+            continue
+        pos = out_ptr[out_row[r]]
+        end = out_ptr[out_row[r] + 1]
+        for j in range(row_ptr[r], row_ptr[r + 1]):
+            if pos == end:
+                break
+            if valid_mask[flat_syms[j]]:
+                out_syms[pos] = flat_syms[j]
+                pos += 1
+
+    return out_syms, out_ptr, keep_row
+
+# Decode packed symptom ids back into per-note lists of symptom names
+def decode_symptom_lists(flat_syms, row_ptr, symptom_names):
+    names = symptom_names[flat_syms].tolist()
+    return [names[start:end] for start, end in zip(row_ptr[:-1], row_ptr[1:])]
 
 # Section 3.3
-def filter_by_freq_and_length(notes_df, min_symptoms=10, min_symptoms_per_note=2, max_symptoms_per_note=50):
-    all_symptoms = [s for lst in notes_df['SYMPTOMS_POS'] for s in lst]
-    symptom_counts = collections.Counter(all_symptoms)
-    valid_symptoms = {sym for sym, cnt in symptom_counts.items() if cnt >= min_symptoms}
+# symptom_lexicon is the id -> name list the SYMPTOMS_POS ids index, i.e. sorted(symptom_set)
+def filter_by_freq_and_length(notes_df, symptom_lexicon, min_symptoms=10, min_symptoms_per_note=2, max_symptoms_per_note=50):
+    # Names are only decoded for the outputs
+    symptom_names = np.array(symptom_lexicon, dtype=object)
+    flat_syms, row_ptr = pack_symptom_lists(notes_df['SYMPTOMS_POS'])
 
     # Frequency filtering
-    all_symptoms = [s for lst in notes_df['SYMPTOMS_POS'] for s in lst]
-    symptom_counts = collections.Counter(all_symptoms)
-    valid_symptoms = {sym for sym, cnt in symptom_counts.items() if cnt >= min_symptoms}
-
-    # Keep only valid symptoms per note
-    notes_df['SYMPTOMS_VALID'] = notes_df['SYMPTOMS_POS'].apply(
-        lambda lst: [s for s in lst if s in valid_symptoms]
-    )
-
-    # Take first 50 symptoms
-    notes_df['SYMPTOMS_TRUNCATED'] = notes_df['SYMPTOMS_VALID'].apply(
-        lambda lst: lst[:max_symptoms_per_note]
+    col_counts = np.bincount(flat_syms, minlength=len(symptom_names))
+    # Lexicon entries that never occur are not valid, even with min_symptoms=0
+    valid_cols = (col_counts >= min_symptoms) & (col_counts > 0)
+    valid_symptoms = set(symptom_names[valid_cols])
+
+    # Keep only valid symptoms, take the first 50 per note, filter out to few symptoms
+    out_syms, out_ptr, keep_rows = filter_and_truncate(
+        flat_syms, row_ptr, valid_cols, max_symptoms_per_note, min_symptoms_per_note
     )
+    filtered_df = notes_df[keep_rows].copy()
 
-    # Filter out to few symptoms
-    filtered_df = notes_df[
-        notes_df['SYMPTOMS_TRUNCATED'].apply(len) >= min_symptoms_per_note
-    ].copy()
-
-    filtered_df['SYMPTOMS_FINAL'] = filtered_df['SYMPTOMS_TRUNCATED']
+    filtered_df['SYMPTOMS_FINAL'] = decode_symptom_lists(out_syms, out_ptr, symptom_names)
     print(f"  Final note count: {len(filtered_df)}")
     return filtered_df, valid_symptoms
 
@@ -268,7 +453,7 @@ def split_data(final_data, train_frac=0.8, val_frac=0.1, test_frac=0.1, random_s
     return train_data, val_data, test_data
 
 # Creates processed_data folder inside data/
-def save_processed_data(train_df, val_df, test_df, symptom_to_index, disease_to_index, output_dir='data/processed_data'):
+def save_processed_data(train_df, val_df, test_df, symptom_to_index, disease_to_index, symptom_lexicon, output_dir='data/processed_data'):
     os.makedirs(output_dir, exist_ok=True)
     
     train_df.to_pickle(os.path.join(output_dir, 'train_data.pkl'))
@@ -283,59 +468,87 @@ def save_processed_data(train_df, val_df, test_df, symptom_to_index, disease_to_
     # Ex. '250' -> 0
     with open(os.path.join(output_dir, 'disease_to_index.pkl'), 'wb') as f:
         pickle.dump(disease_to_index, f)
+
+    # Decodes the raw id columns (RAW_SYMPTOM_IDS, SYMPTOMS_POS). Ex. 0 -> 'abdominal pain'
+    with open(os.path.join(output_dir, 'symptom_lexicon.pkl'), 'wb') as f:
+        pickle.dump(list(symptom_lexicon), f)
     
     print(f"Processed data saved to {output_dir}")
 
-if __name__ == "__main__":
-    data_directory = "data"
-    top_n_diseases = 50
-
-    print("Loading MIMIC-III data...")
-    mimic_data = load_mimic_data(data_directory)
-
-    print('Dataset Summary...')
-    for table_name, df in mimic_data.items():
-        print(f"{table_name}: {df.shape[0]} rows, {df.shape[1]} columns")
-
-    noteevents_df = mimic_data['NOTEEVENTS']
+# Pipeline stages, checkpointed under cache/. Delete the folder to force a full rerun
+@cache_to_parquet('cache/filtered_notes.parquet', inputs=('{data_dir}/NOTEEVENTS.csv.gz',))
+def load_discharge_notes(data_dir):
+    data = {'NOTEEVENTS': load_mimic_table(data_dir, 'NOTEEVENTS')}
+    print(f"NOTEEVENTS (discharge summaries): {data['NOTEEVENTS'].shape[0]} rows, {data['NOTEEVENTS'].shape[1]} columns")
     print("Filtering Discharge Notes...")
-    filtered_notes = filter_discharges(mimic_data, noteevents_df)
+    return filter_discharges(data, data['NOTEEVENTS'])
 
+@cache_to_parquet('cache/diagnoses.parquet', inputs=('{data_dir}/DIAGNOSES_ICD.csv.gz',))
+def load_diagnoses(data_dir):
+    diag_codes_df = load_mimic_table(data_dir, 'DIAGNOSES_ICD')
+    print(f"DIAGNOSES_ICD: {diag_codes_df.shape[0]} rows, {diag_codes_df.shape[1]} columns")
     print("Truncating ICD9 Codes...")
-    diag_codes_df = mimic_data['DIAGNOSES_ICD']
-    diagnoses = truncate_icd9_codes(diag_codes_df)
-
-    print("Selecting Top Diseases...")
-    top_diseases, disease_to_index, coverage = select_top_diseases(diagnoses, top_n=top_n_diseases)
-
-    print("\n Top Diseases")
-    for i, disease in enumerate(top_diseases[:10], 1):
-        print(f"{i}. {disease}")
-
-    print("Filtering for Top Diseases...")
-    filtered_diagnoses, filtered_notes = filter_top_diseases(diagnoses, filtered_notes, top_diseases)
-
+    return truncate_icd9_codes(diag_codes_df)
+
+# top_n only keys the cache file; notes_df is already filtered to the top-N diseases
+@cache_to_parquet(
+    'cache/final_notes_top{top_n}.parquet',
+    inputs=('cache/filtered_notes.parquet', 'cache/diagnoses.parquet'),
+)
+def extract_final_notes(notes_df, top_n):
     print("Identifying Sections in Discharge Summaries...")
-    filtered_notes['TEXT_FILTERED'] = filtered_notes['TEXT'].apply(filter_sections)
+    with Pool(os.cpu_count()) as pool:
+        notes_df['TEXT_FILTERED'] = pool.map(
+            filter_sections, notes_df['TEXT'].tolist(), chunksize=256
+        )
+
+    print("Normalizing note text...")
+    # Only needed for extraction, so it is not kept as a column
+    normalized_texts = normalize_notes(notes_df['TEXT_FILTERED']).tolist()
 
     print("Extracting symptoms (mocking MetaMap)...")
-    filtered_notes['RAW_SYMPTOMS'] = filtered_notes['TEXT_FILTERED'].apply(
-        lambda x: extract_symptoms_from_text(x, SYMPTOMS)
-    )
+    with Pool(os.cpu_count(), initializer=_init_symptom_worker, initargs=(SYMPTOMS,)) as pool:
+        raw_symptoms = pool.map(
+            partial(extract_symptoms_from_text, symptom_set=SYMPTOMS),
+            normalized_texts,
+            chunksize=256
+        )
+    # Parallel id / negation arrays, which Parquet stores natively
+    notes_df['RAW_SYMPTOM_IDS'] = [sym_ids for sym_ids, _ in raw_symptoms]
+    notes_df['RAW_NEGATED'] = [negated for _, negated in raw_symptoms]
 
     print("Removing Negative Symptoms...")
-    filtered_notes['SYMPTOMS_POS'] = filtered_notes['RAW_SYMPTOMS'].apply(
-        # filters out negated symptoms
-        lambda lst: [item['symptom'] for item in lst if not item['is_negated']]
-    )
+    notes_df['SYMPTOMS_POS'] = [sym_ids[~negated] for sym_ids, negated in raw_symptoms]
 
     print("Applying symptom frequency and length filtering...")
     final_notes_df, valid_symptoms = filter_by_freq_and_length(
-        filtered_notes,
+        notes_df,
+        SYM_LIST,
         min_symptoms=10,
         min_symptoms_per_note=2,
         max_symptoms_per_note=50
     )
+    return final_notes_df
+
+if __name__ == "__main__":
+    data_directory = "data"
+    top_n_diseases = 50
+
+    print("Loading MIMIC-III data...")
+    filtered_notes = load_discharge_notes(data_dir=data_directory)
+    diagnoses = load_diagnoses(data_dir=data_directory)
+
+    print("Selecting Top Diseases...")
+    top_diseases, disease_to_index, coverage, top_set = select_top_diseases(diagnoses, top_n=top_n_diseases)
+
+    print("\n Top Diseases")
+    for i, disease in enumerate(top_diseases[:10], 1):
+        print(f"{i}. {disease}")
+
+    print("Filtering for Top Diseases...")
+    filtered_diagnoses, filtered_notes = filter_top_diseases(diagnoses, filtered_notes, top_set)
+
+    final_notes_df = extract_final_notes(notes_df=filtered_notes, top_n=top_n_diseases)
 
     # map symtpoms to integers
     symptom_to_index = build_symptom_dict(final_notes_df)
@@ -350,7 +563,7 @@ if __name__ == "__main__":
     train_df, val_df, test_df = split_data(final_data)
     
     print("Saving processed data...")
-    save_processed_data(train_df, val_df, test_df, symptom_to_index, disease_to_index)
+    save_processed_data(train_df, val_df, test_df, symptom_to_index, disease_to_index, SYM_LIST)
     
     print("\nPreprocessing complete.")
 